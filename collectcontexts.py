@@ -2,30 +2,50 @@
 from argparse import ArgumentParser
 import os
 import pickle
+import time
 
 from tf.fabric import Fabric
 
-from hebrewreader import DATADIR, FEATURES, load_data
-from minitf import gather_context
+from hebrewreader import DATADIR, FEATURES, load_data, build_concordance
+from minitf import ContextGatherer, gather_context
+
+BENCHMARK_RUNS = 3
 
 VERSE_NODES = dict()
+VERSE_WORDS = dict()
+
+# For the concordance: all verses in canonical order, and for each lex node
+# its features and the indices in VERSES of the verses it occurs in
+VERSES = []
+LEXEMES = dict()
 
 def gather_chapter(api, book, chap):
     global VERSE_NODES
+    global VERSE_WORDS
     nodes = set()
     node = api.T.nodeFromSection((book, chap, 1))
     if node is None:
         return None
     verse = 1
     VERSE_NODES[book][chap] = dict()
+    VERSE_WORDS[book][chap] = dict()
     while api.T.sectionFromNode(node)[0:2] == (book,chap):
         verse = api.T.sectionFromNode(node)[2]
         VERSE_NODES[book][chap][verse] = node
+        index = len(VERSES)
+        VERSES.append((book, chap, verse))
         nodes.add(node)
         words = api.L.d(node, 'word')
+        VERSE_WORDS[book][chap][verse] = len(words)
         nodes.update(set(words))
         for word in words:
-            nodes.update(set(api.L.u(word, 'lex')))
+            lexes = api.L.u(word, 'lex')
+            nodes.update(set(lexes))
+            for lex in lexes:
+                if lex not in LEXEMES:
+                    LEXEMES[lex] = (api.F.lex_utf8.v(word), api.F.voc_lex_utf8.v(lex),
+                            api.F.gloss.v(lex), [])
+                LEXEMES[lex][3].append(index)
         next_verse = api.L.n(node, 'verse')
         if next_verse == ():
             break
@@ -34,9 +54,11 @@ def gather_chapter(api, book, chap):
 
 def gather_book(api, book):
     global VERSE_NODES
+    global VERSE_WORDS
     result = dict()
     chap = 1
     VERSE_NODES[book] = dict()
+    VERSE_WORDS[book] = dict()
     while True:
         nodes = gather_chapter(api, book, chap)
         if nodes is None:
@@ -44,29 +66,66 @@ def gather_book(api, book):
         result[chap] = nodes
         chap += 1
 
-def dump_book(api, book):
+def dump_book(api, gatherer, book):
     nodesets = gather_book(api, book)
     for chap, nodes in nodesets.items():
-        context = gather_context(
-                api,
+        context = gatherer.gather(
                 {'features': FEATURES, 'locality': 'udnp'},
                 (nodes,))
         fname = book + '_' + str(chap) + '.pkl'
         with open(os.path.join(DATADIR, fname), 'wb') as f:
             pickle.dump(context, f)
 
-def gather(locations, modules):
+def benchmark_book(api, gatherer, book):
+    nodesets = gather_book(api, book)
+    spec = {'features': FEATURES, 'locality': 'udnp'}
+
+    # build the feature arrays outside the timed section; this is done only
+    # once for all books
+    gatherer.gather(spec, (nodesets[1],))
+
+    # report the best of a few runs, as timings of single runs vary a lot
+    loop_time = vectorized_time = float('inf')
+    for _ in range(BENCHMARK_RUNS):
+        start = time.perf_counter()
+        contexts = [gather_context(api, spec, (nodes,)) for nodes in nodesets.values()]
+        loop_time = min(loop_time, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        vectorized = [gatherer.gather(spec, (nodes,)) for nodes in nodesets.values()]
+        vectorized_time = min(vectorized_time, time.perf_counter() - start)
+
+    if contexts != vectorized:
+        raise ValueError('Vectorized contexts differ for {}'.format(book))
+
+    print('{}: {} chapters'.format(book, len(nodesets)))
+    print('gather_context:          {:.3f}s'.format(loop_time))
+    print('ContextGatherer.gather:  {:.3f}s ({:.1f}x)'.format(
+        vectorized_time, loop_time / vectorized_time))
+
+def gather(locations, modules, benchmark=None):
     TF = Fabric(locations=locations, modules=modules, silent=True)
     api = TF.load(FEATURES, silent=True)
+    gatherer = ContextGatherer(api)
+
+    if benchmark is not None:
+        benchmark_book(api, gatherer, benchmark)
+        return
 
     for node in api.F.otype.s('book'):
         book = api.T.sectionFromNode(node)[0]
         print(book)
-        dump_book(api, book)
+        dump_book(api, gatherer, book)
 
     with open(os.path.join(DATADIR, 'verse_nodes.pkl'), 'wb') as f:
         pickle.dump(VERSE_NODES, f)
 
+    with open(os.path.join(DATADIR, 'verse_words.pkl'), 'wb') as f:
+        pickle.dump(VERSE_WORDS, f)
+
+    with open(os.path.join(DATADIR, 'concordance.pkl'), 'wb') as f:
+        pickle.dump(build_concordance(VERSES, LEXEMES), f)
+
 def main():
     parser = ArgumentParser(description='Gather the TF contexts to reduce memory usage in the HTTP server')
 
@@ -76,9 +135,12 @@ def main():
     p_data.add_argument('--module', '-m', nargs=1, required=True,
             help='Text-fabric module to load')
 
+    parser.add_argument('--benchmark', metavar='BOOK',
+            help='Compare the speed of the context gatherers on one book instead of writing data')
+
     args = parser.parse_args()
 
-    gather(args.bhsa, args.module)
+    gather(args.bhsa, args.module, args.benchmark)
 
 if __name__ == '__main__':
     main()
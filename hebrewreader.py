@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser, FileType, RawTextHelpFormatter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import hashlib
+from html import escape
 import os
 import pickle
 import re
-from shutil import copyfile
+from shutil import copyfile, rmtree
 import subprocess
 import sys
 import tempfile
 import textwrap
+import threading
+import time
+import unicodedata
 
+import numpy as np
 from tf.fabric import Fabric
 
 import minitf
@@ -23,13 +32,148 @@ PASSAGE_RGX = (
 
 FEATURES = 'g_word_utf8 gloss lex_utf8 otype trailer_utf8 voc_lex_utf8'
 
-VERSE_NODES = dict()
+# Used for cost estimates when verse_words.pkl is not available
+AVERAGE_VERSE_WORDS = 18
+
+FRAGMENT_CACHE_SIZE = 512
+FRAGMENT_CACHE_BYTES = 64 * 2**20
+
+# Target size of the chunks for generate_pdf_chunked
+CHUNK_VERSES = 300
+
+CONCORDANCE_PAGE_SIZE = 50
+
+TEX_TEXT_TEMPLATES = {
+        'chapno': r'\rdrchap{%d}', 'verseno': r'\rdrverse{%d}',
+        'setuma': r'\setuma{}', 'petucha': r'\petucha{}',
+        'meta_gloss': r'\\textit{\1}',
+        }
+
+def data_version(datadir):
+    h = hashlib.sha1()
+    for fname in sorted(os.listdir(datadir)):
+        stat = os.stat(os.path.join(datadir, fname))
+        h.update('{}:{}:{}\0'.format(fname, stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()
+
+# A loaded version of the data directory. The directory is resolved when the
+# data is loaded, so that if DATADIR is a symlink it can be pointed to a new
+# version while requests using the old version are still running.
+class Data(object):
+    def __init__(self, datadir=DATADIR):
+        self.datadir = os.path.realpath(datadir)
+        self.version = data_version(self.datadir)
+
+        with open(os.path.join(self.datadir, 'verse_nodes.pkl'), 'rb') as f:
+            self.verse_nodes = pickle.load(f)
+
+        try:
+            with open(os.path.join(self.datadir, 'verse_words.pkl'), 'rb') as f:
+                self.verse_words = pickle.load(f)
+        except FileNotFoundError:
+            self.verse_words = dict()
+
+        try:
+            with open(os.path.join(self.datadir, 'concordance.pkl'), 'rb') as f:
+                self.concordance = Concordance(pickle.load(f))
+        except FileNotFoundError:
+            self.concordance = None
+
+# Verse lists in the concordance are sorted indices into the list of all
+# verses, stored as the differences between consecutive indices.
+def encode_verses(verses):
+    deltas = np.diff(np.asarray(sorted(set(verses)), dtype=np.int64), prepend=0)
+    return deltas.astype(np.min_scalar_type(deltas.max() if len(deltas) else 0))
+
+def decode_verses(deltas):
+    return np.cumsum(deltas, dtype=np.int64)
+
+# An inverted index from lexemes to the verses they occur in. The index is
+# built by collectcontexts.py with build_concordance and has the keys:
+# - verses: all (book, chapter, verse) references in canonical order;
+# - books: for each book, the range of its indices in verses;
+# - lexemes: for each lexeme (lex node), a tuple (lex_utf8, voc_lex_utf8,
+#   gloss, encoded verses);
+# - lookup: a mapping from lex_utf8 and voc_lex_utf8 to lexemes.
+class Concordance(object):
+    def __init__(self, index):
+        self.verses = index['verses']
+        self.books = index['books']
+        self.lexemes = index['lexemes']
+        self.lookup = index['lookup']
+
+    def find(self, lex):
+        return sorted(set(self.lookup.get(unicodedata.normalize('NFC', lex.strip()), [])))
+
+    def search(self, lex, book=None, page=1, page_size=CONCORDANCE_PAGE_SIZE):
+        lexemes = self.find(lex)
+        if len(lexemes) == 0:
+            raise KeyError(lex)
+
+        verses = [decode_verses(self.lexemes[l][3]) for l in lexemes]
+        verses = verses[0] if len(verses) == 1 else np.unique(np.concatenate(verses))
+
+        if book is not None:
+            book = book.replace(' ', '_')
+            if book not in self.books:
+                raise ValueError('Unknown book "{}"'.format(book))
+            start, end = self.books[book]
+            verses = verses[np.searchsorted(verses, start):np.searchsorted(verses, end)]
+
+        pages = max((len(verses) + page_size - 1) // page_size, 1)
+        offset = (page - 1) * page_size
+        return {
+                'lexemes': [{
+                    'lex': self.lexemes[l][0],
+                    'voc_lex': self.lexemes[l][1],
+                    'gloss': self.lexemes[l][2],
+                    } for l in lexemes],
+                'book': None if book is None else book.replace('_', ' '),
+                'total': len(verses),
+                'page': page,
+                'pages': pages,
+                'verses': ['{} {}:{}'.format(b.replace('_', ' '), c, v)
+                    for b, c, v in (self.verses[i] for i in verses[offset:offset+page_size])],
+                }
+
+# Build the index for Concordance from a list of (book, chapter, verse)
+# references and, for each lex node, its features and the verse indices it
+# occurs in.
+def build_concordance(verses, lexemes):
+    books = dict()
+    for i, (book, _, _) in enumerate(verses):
+        books[book] = (books.get(book, (i, i))[0], i + 1)
+
+    index = {'verses': verses, 'books': books, 'lexemes': dict(), 'lookup': dict()}
+    for node, (lex, voc_lex, gloss, occurrences) in lexemes.items():
+        index['lexemes'][node] = (lex, voc_lex, gloss, encode_verses(occurrences))
+        for key in {lex, voc_lex} - {None}:
+            key = unicodedata.normalize('NFC', key)
+            index['lookup'].setdefault(key, []).append(node)
+    return index
+
+DATA = None
+
+PINNED_DATA = threading.local()
+
+def current_data():
+    data = getattr(PINNED_DATA, 'data', None)
+    return DATA if data is None else data
+
+# Use a specific version of the data in the current thread.
+@contextmanager
+def use_data(data):
+    previous = getattr(PINNED_DATA, 'data', None)
+    PINNED_DATA.data = data
+    try:
+        yield data
+    finally:
+        PINNED_DATA.data = previous
 
 def load_verse_nodes():
-    global VERSE_NODES
+    global DATA
 
-    with open(os.path.join(DATADIR, 'verse_nodes.pkl'), 'rb') as f:
-        VERSE_NODES = pickle.load(f)
+    DATA = Data()
 
 def parse_passage(passage):
     match = re.match(PASSAGE_RGX, passage)
@@ -39,6 +183,8 @@ def parse_passage(passage):
     else:
         match = match.groupdict()
 
+    verse_nodes = current_data().verse_nodes
+
     match['book'] = match['book'].replace(' ', '_')
     match['startchap'] = int(match['startchap'])
     if match['startverse'] is not None:
@@ -56,46 +202,102 @@ def parse_passage(passage):
                 match['endchap'] = match['startchap']
                 match['endverse'] = match['startverse']
         elif match['endverse'] is None:
-            match['endverse'] = len(VERSE_NODES[match['book']][match['endchap']])
+            match['endverse'] = len(verse_nodes[match['book']][match['endchap']])
 
         if match['startverse'] is None:
             match['startverse'] = 1
 
         if match['endref'] == 'end':
             match['endchap'] = match['startchap']
-            match['endverse'] = len(VERSE_NODES[match['book']][match['endchap']])
+            match['endverse'] = len(verse_nodes[match['book']][match['endchap']])
         elif match['endref'] == 'bookend':
-            match['endchap'] = len(VERSE_NODES[match['book']])
-            match['endverse'] = len(VERSE_NODES[match['book']][match['endchap']])
+            match['endchap'] = len(verse_nodes[match['book']])
+            match['endverse'] = len(verse_nodes[match['book']][match['endchap']])
+
+        # Make sure that the passage exists, so that verses_in_passage does
+        # not run into unknown chapters
+        verse_nodes[match['book']][match['startchap']][match['startverse']]
+        verse_nodes[match['book']][match['endchap']][match['endverse']]
     except:
         raise ValueError('Could not find reference "{}"'.format(passage))
 
     match.pop('endref')
     return match
 
+def pretty_passage(passage):
+    return '{} {}:{} - {}:{}'.format(
+        passage['book'].replace('_', ' '),
+        passage['startchap'], passage['startverse'],
+        passage['endchap'], passage['endverse'])
+
+# Split a passage at chapter boundaries into parts of at most max_verses
+# verses (unless a single chapter is longer).
+def split_passage(passage, max_verses):
+    verse_nodes = current_data().verse_nodes
+    book = passage['book']
+    parts = []
+    start = (passage['startchap'], passage['startverse'])
+    count = 0
+    for chap in range(passage['startchap'], passage['endchap']+1):
+        first = passage['startverse'] if chap == passage['startchap'] else 1
+        last = passage['endverse'] if chap == passage['endchap'] else len(verse_nodes[book][chap])
+        if count > 0 and count + last - first + 1 > max_verses:
+            parts.append({'book': book,
+                'startchap': start[0], 'startverse': start[1],
+                'endchap': chap-1, 'endverse': len(verse_nodes[book][chap-1])})
+            start = (chap, 1)
+            count = 0
+        count += last - first + 1
+    parts.append({'book': book,
+        'startchap': start[0], 'startverse': start[1],
+        'endchap': passage['endchap'], 'endverse': passage['endverse']})
+    return parts
+
 def verses_in_passage(passage):
+    verse_nodes = current_data().verse_nodes
     for chap in range(passage['startchap'], passage['endchap']+1):
         start = passage['startverse'] if chap == passage['startchap'] else 1
         if chap == passage['endchap']:
             end = passage['endverse']
         else:
-            end = len(VERSE_NODES[passage['book']][chap])
+            end = len(verse_nodes[passage['book']][chap])
 
         for verse in range(start, end+1):
             yield (passage['book'], chap, verse)
 
+def count_words(passage):
+    verse_words = current_data().verse_words
+    words = 0
+    for book, chap, verse in verses_in_passage(passage):
+        try:
+            words += verse_words[book][chap][verse]
+        except KeyError:
+            words += AVERAGE_VERSE_WORDS
+    return words
+
 def fix_trailer(trailer, templates):
     return trailer\
             .replace('\n', '')\
             .replace('\u05e1', templates['setuma'])\
             .replace('\u05e4', templates['petucha'])
 
-def fix_gloss(gloss, templates):
+# With escape_text, the gloss is escaped before meta glosses are marked up, so
+# that the template can contain markup.
+def fix_gloss(gloss, templates, escape_text=None):
     if gloss == 'i':
         return 'I'
-    return re.sub(r'<(.*)>', templates['meta_gloss'], gloss)
-
-def get_passage_and_words(passage, api, templates, separate_chapters=True, verse_nos=True):
+    meta = r'<(.*)>'
+    if escape_text is not None:
+        gloss = escape_text(gloss)
+        meta = re.escape(escape_text('<')) + '(.*)' + re.escape(escape_text('>'))
+    return re.sub(meta, templates['meta_gloss'], gloss)
+
+def get_passage_and_words(passage, api, templates, separate_chapters=True, verse_nos=True,
+        escape_text=None):
+    if escape_text is None:
+        escape_text = lambda text: text
+
+    verse_nodes = current_data().verse_nodes
     text = []
     words = set()
 
@@ -105,7 +307,7 @@ def get_passage_and_words(passage, api, templates, separate_chapters=True, verse
             last_chapter = verse[1]
             if separate_chapters:
                 text.append('\n')
-        node = VERSE_NODES[verse[0]][verse[1]][verse[2]]
+        node = verse_nodes[verse[0]][verse[1]][verse[2]]
         wordnodes = api.L.d(node, otype='word')
         thistext = ''
         if verse_nos:
@@ -115,16 +317,128 @@ def get_passage_and_words(passage, api, templates, separate_chapters=True, verse
         thiswords = []
         for word in wordnodes:
             thiswords.append(
-                    api.F.g_word_utf8.v(word) +
-                    fix_trailer(api.F.trailer_utf8.v(word), templates))
+                    escape_text(api.F.g_word_utf8.v(word)) +
+                    fix_trailer(escape_text(api.F.trailer_utf8.v(word)), templates))
             lex = api.L.u(word, otype='lex')[0]
-            words.add((api.F.lex_utf8.v(word), api.F.voc_lex_utf8.v(lex), fix_gloss(api.F.gloss.v(lex), templates)))
+            words.add((api.F.lex_utf8.v(word), api.F.voc_lex_utf8.v(lex), fix_gloss(api.F.gloss.v(lex), templates, escape_text)))
         thistext += ''.join(thiswords)
         text.append(thistext)
 
     return text, sorted(words)
 
+# An LRU cache holding at most maxsize items. With maxbytes, the total size of
+# the items as given by sizeof is also limited, and larger items are not
+# cached at all.
+class LRUCache(object):
+    def __init__(self, maxsize, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.items = OrderedDict()
+        self.sizes = dict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items.move_to_end(key)
+            return item
+
+    def put(self, key, item):
+        size = self.sizeof(item) if self.maxbytes is not None else 0
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        with self.lock:
+            self.remove(key)
+            self.items[key] = item
+            self.sizes[key] = size
+            self.bytes += size
+            while len(self.items) > self.maxsize or \
+                    (self.maxbytes is not None and self.bytes > self.maxbytes):
+                self.remove(next(iter(self.items)))
+
+    # Must be called with the lock held.
+    def remove(self, key):
+        if key in self.items:
+            del self.items[key]
+            self.bytes -= self.sizes.pop(key)
+
+    def invalidate(self, predicate):
+        with self.lock:
+            for key in [key for key in self.items if predicate(key)]:
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.sizes.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                    'size': len(self.items),
+                    'maxsize': self.maxsize,
+                    'bytes': self.bytes,
+                    'maxbytes': self.maxbytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                    }
+
+# A fragment is (text, words, rendered vocabulary); see render_passage.
+def fragment_size(fragment):
+    text, words, voca = fragment
+    return sys.getsizeof(text) + sys.getsizeof(voca) + \
+            sum(sys.getsizeof(word) + sum(map(sys.getsizeof, word)) for word in words)
+
+FRAGMENT_CACHE = LRUCache(maxsize=FRAGMENT_CACHE_SIZE,
+        maxbytes=FRAGMENT_CACHE_BYTES, sizeof=fragment_size)
+
+def passage_key(passage):
+    return (passage['book'],
+            passage['startchap'], passage['startverse'],
+            passage['endchap'], passage['endverse'])
+
+def templates_hash(templates):
+    h = hashlib.sha1()
+    for key in sorted(templates):
+        h.update(key.encode('utf-8') + b'\0')
+        h.update(templates[key].encode('utf-8') + b'\0')
+    return h.hexdigest()
+
+# Returns (body, words, voca) for a single passage, where words is the sorted
+# word list (for combined vocabularies) and voca is render_voca(words).
+def render_passage(passage, templates, flavor, render_voca, escape_text=None):
+    key = (current_data().version, passage_key(passage), flavor, templates_hash(templates))
+    fragment = FRAGMENT_CACHE.get(key)
+    if fragment is None:
+        api = load_data(passage)
+        text, words = get_passage_and_words(passage, api, templates,
+                escape_text=escape_text)
+        fragment = ('\n'.join(text), words, render_voca(words))
+        # After a reload, requests that still use the old data should not
+        # fill the cache with fragments that nobody will use again
+        if current_data() is DATA:
+            FRAGMENT_CACHE.put(key, fragment)
+    return fragment
+
 def load_data(passage):
+    datadir = current_data().datadir
     seen = set()
     context = dict()
     for book, chap, _ in verses_in_passage(passage):
@@ -132,7 +446,7 @@ def load_data(passage):
             continue
         seen.add((book, chap))
         fname = book + '_' + str(chap) + '.pkl'
-        with open(os.path.join(DATADIR, fname), 'rb') as f:
+        with open(os.path.join(datadir, fname), 'rb') as f:
             add_context = pickle.load(f)
             for key, val in add_context.items():
                 if key not in context:
@@ -147,7 +461,33 @@ def load_data(passage):
     api = minitf.MiniApi(**context)
     return api
 
-def generate_txt(passages, include_voca, combine_voca, txt):
+def render_txt_voca(words):
+    return '\n'.join('%s: %s' % (lex,gloss) for _, lex, gloss in words)
+
+def render_tex_voca(words, fontsize=r'\vocafontsize'):
+    return '\\\\\n'.join(
+            r'{\hebrewfont%s\RL{%s}} \begin{english}%s\end{english}' % (fontsize, lex, gloss)
+            for _, lex, gloss in words)
+
+# The glosses have already been escaped by get_passage_and_words.
+def render_html_voca(words):
+    return '\n'.join(
+            '<tr><td class="lex" lang="he" dir="rtl">%s</td><td>%s</td></tr>' % (escape(lex), gloss)
+            for _, lex, gloss in words)
+
+# Deadlines are absolute times (or None). The generators check them between
+# passages, and the remaining time is the timeout for xelatex.
+def make_deadline(timeout):
+    return None if timeout is None else time.time() + timeout
+
+def time_left(deadline):
+    return None if deadline is None else max(deadline - time.time(), 0)
+
+def check_deadline(deadline):
+    if deadline is not None and time.time() > deadline:
+        raise TimeoutError('Timed out!')
+
+def generate_txt(passages, include_voca, combine_voca, txt, deadline=None):
     voca = set()
 
     templates = {
@@ -158,6 +498,7 @@ def generate_txt(passages, include_voca, combine_voca, txt):
 
     first = True
     for passage_text in passages:
+        check_deadline(deadline)
         passage = parse_passage(passage_text)
 
         if not first:
@@ -165,16 +506,13 @@ def generate_txt(passages, include_voca, combine_voca, txt):
         first = False
 
         try:
-            api = load_data(passage)
-            text, words = get_passage_and_words(passage, api, templates)
+            body, words, words_txt = render_passage(
+                    passage, templates, 'txt', render_txt_voca)
         except:
             raise ValueError('Could not find reference "{}"'.format(passage_text))
 
-        passage_pretty = '{} {}:{} - {}:{}'.format(
-            passage['book'].replace('_', ' '),
-            passage['startchap'], passage['startverse'],
-            passage['endchap'], passage['endverse'])
-        txt.write(passage_pretty + '\n'.join(text))
+        passage_pretty = pretty_passage(passage)
+        txt.write(passage_pretty + body)
 
         if not include_voca:
             continue
@@ -182,50 +520,132 @@ def generate_txt(passages, include_voca, combine_voca, txt):
         if combine_voca:
             voca.update(words)
         else:
-            txt.write('\n\n' + '\n'.join('%s: %s' % (lex,gloss) for _, lex, gloss in words))
+            txt.write('\n\n' + words_txt)
 
     if include_voca and combine_voca:
-        txt.write('\n\n' + '\n'.join('%s: %s' % (lex,gloss) for _, lex, gloss in sorted(voca)))
+        txt.write('\n\n' + render_txt_voca(sorted(voca)))
 
     txt.close()
 
     return txt.name
 
-def generate_tex(passages, include_voca, combine_voca, clearpage_before_voca,
-        large_text, larger_text, tex, templates):
-    tex.write(templates['pre'])
+def generate_html(passages, include_voca, combine_voca, large_text, larger_text,
+        html, templates, deadline=None):
+    html.write(templates['prehtml'])
 
+    classes = ['reader']
     if large_text:
-        tex.write('\\largetexttrue\n')
+        classes.append('largetext')
     if larger_text:
-        tex.write('\\largertexttrue\n')
+        classes.append('largertext')
+    html.write('<div class="%s">\n' % ' '.join(classes))
 
     voca = set()
 
     text_templates = {
-            'chapno': r'\rdrchap{%d}', 'verseno': r'\rdrverse{%d}',
-            'setuma': r'\setuma{}', 'petucha': r'\petucha{}',
-            'meta_gloss': r'\\textit{\1}',
+            'chapno': '<span class="chap">%d</span> ',
+            'verseno': '<sup class="verse">%d</sup>',
+            'setuma': '<span class="setuma">ס</span>',
+            'petucha': '<span class="petucha">פ</span>',
+            'meta_gloss': r'<i>\1</i>',
             }
 
     for passage_text in passages:
+        check_deadline(deadline)
         passage = parse_passage(passage_text)
 
-        passage_pretty = '{} {}:{} - {}:{}'.format(
-            passage['book'].replace('_', ' '),
-            passage['startchap'], passage['startverse'],
-            passage['endchap'], passage['endverse'])
-        tex.write(r'\def\thepassage{%s}' % passage_pretty)
+        passage_pretty = pretty_passage(passage)
+        html.write('<h2>%s</h2>\n' % escape(passage_pretty))
 
         try:
-            api = load_data(passage)
-            text, words = get_passage_and_words(passage, api, text_templates)
+            body, words, words_html = render_passage(
+                    passage, text_templates, 'html', render_html_voca,
+                    escape_text=escape)
         except:
             raise ValueError('Could not find reference "{}"'.format(passage_text))
 
+        html.write('<div class="text" lang="he" dir="rtl">\n')
+        for paragraph in re.split(r'\n\s*\n', body):
+            if paragraph.strip() != '':
+                html.write('<p>%s</p>\n' % paragraph)
+        html.write('</div>\n')
+
+        if not include_voca:
+            continue
+
+        if combine_voca:
+            voca.update(words)
+        else:
+            html.write('<h3>Vocabulary</h3>\n<table class="voca">\n')
+            html.write(words_html)
+            html.write('\n</table>\n')
+
+    if include_voca and combine_voca:
+        html.write('<h2>Vocabulary</h2>\n<table class="voca">\n')
+        html.write(render_html_voca(sorted(voca)))
+        html.write('\n</table>\n')
+
+    html.write('</div>\n')
+    html.write(templates['posthtml'])
+
+    return html
+
+def write_tex_pre(tex, large_text, larger_text, templates):
+    tex.write(templates['pre'])
+
+    if large_text:
+        tex.write('\\largetexttrue\n')
+    if larger_text:
+        tex.write('\\largertexttrue\n')
+
+# While writing the pretext template for a continued passage, \section does
+# nothing, so that the heading of the passage is not repeated. The template
+# may open groups, so \section is restored globally.
+TEX_HIDE_SECTION = r'\let\rdrsection\section\makeatletter\def\section{\@ifstar\@gobble\@gobble}\makeatother'
+TEX_RESTORE_SECTION = r'\global\let\section\rdrsection'
+
+# Returns the words of the passage and the rendered vocabulary list. When the
+# passage is a part of a larger passage (see split_passage), title is that
+# passage and continued is set for all parts but the first, which then do not
+# get a heading.
+def write_tex_passage(tex, passage, passage_text, templates, title=None, continued=False):
+    tex.write(r'\def\thepassage{%s}' % pretty_passage(passage if title is None else title))
+
+    try:
+        body, words, words_tex = render_passage(
+                passage, TEX_TEXT_TEMPLATES, 'tex', render_tex_voca)
+    except:
+        raise ValueError('Could not find reference "{}"'.format(passage_text))
+
+    if continued:
+        tex.write('\n\n' + TEX_HIDE_SECTION)
+        tex.write('\n' + templates['pretext'])
+        tex.write(TEX_RESTORE_SECTION + '\n')
+    else:
         tex.write('\n\n' + templates['pretext'])
-        tex.write('\n'.join(text))
-        tex.write('\n' + templates['posttext'])
+    tex.write(body)
+    tex.write('\n' + templates['posttext'])
+
+    return words, words_tex
+
+def write_tex_voca(tex, voca_tex, clearpage_before_voca, templates):
+    if clearpage_before_voca:
+        tex.write('\n\n\\clearpage')
+    tex.write('\n\n' + templates['prevoca'])
+    tex.write(voca_tex)
+    tex.write('\n' + templates['postvoca'])
+
+def generate_tex(passages, include_voca, combine_voca, clearpage_before_voca,
+        large_text, larger_text, tex, templates, deadline=None):
+    write_tex_pre(tex, large_text, larger_text, templates)
+
+    voca = set()
+
+    for passage_text in passages:
+        check_deadline(deadline)
+        passage = parse_passage(passage_text)
+
+        words, words_tex = write_tex_passage(tex, passage, passage_text, templates)
 
         if not include_voca:
             continue
@@ -233,18 +653,11 @@ def generate_tex(passages, include_voca, combine_voca, clearpage_before_voca,
         if combine_voca:
             voca.update(words)
         else:
-            if clearpage_before_voca:
-                tex.write('\n\n\\clearpage')
-            tex.write('\n\n' + templates['prevoca'])
-            tex.write('\\\\\n'.join(r'{\hebrewfont\vocafontsize\RL{%s}} \begin{english}%s\end{english}' % (lex,gloss) for _, lex, gloss in words))
-            tex.write('\n' + templates['postvoca'])
+            write_tex_voca(tex, words_tex, clearpage_before_voca, templates)
 
     if include_voca and combine_voca:
-        if clearpage_before_voca:
-            tex.write('\n\n\\clearpage')
-        tex.write('\n\n' + templates['prevoca'])
-        tex.write('\\\\\n'.join(r'{\hebrewfont\RL{%s}} \begin{english}%s\end{english}' % (lex,gloss) for _, lex, gloss in sorted(voca)))
-        tex.write('\n' + templates['postvoca'])
+        write_tex_voca(tex, render_tex_voca(sorted(voca), fontsize=''),
+                clearpage_before_voca, templates)
 
     tex.write(templates['post'])
 
@@ -252,11 +665,7 @@ def generate_tex(passages, include_voca, combine_voca, clearpage_before_voca,
 
     return tex.name
 
-def generate_pdf(passages, include_voca, combine_voca, clearpage_before_voca,
-        large_text, larger_text, tex, pdf, templates, quiet=False):
-    tex = generate_tex(passages, include_voca, combine_voca,
-            clearpage_before_voca, large_text, larger_text, tex, templates)
-
+def run_xelatex(tex, pdf, quiet=False, timeout=None):
     path, filename = os.path.split(pdf)
     jobname, _ = os.path.splitext(filename)
 
@@ -269,13 +678,112 @@ def generate_pdf(passages, include_voca, combine_voca, clearpage_before_voca,
     cmd.append(tex)
 
     if quiet:
-        null = open(os.devnull, 'wb')
-        subprocess.call(cmd, stdout=null, stderr=null)
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                timeout=timeout)
     else:
-        subprocess.run(cmd)
+        result = subprocess.run(cmd, timeout=timeout)
+
+    # The output file may already exist (e.g. from mkstemp), so an empty file
+    # also means that the compilation failed
+    if result.returncode != 0 or not os.path.isfile(pdf) or os.path.getsize(pdf) == 0:
+        raise ValueError('Could not compile {}'.format(tex))
+
+def generate_pdf(passages, include_voca, combine_voca, clearpage_before_voca,
+        large_text, larger_text, tex, pdf, templates, quiet=False, timeout=None):
+    deadline = make_deadline(timeout)
+    tex = generate_tex(passages, include_voca, combine_voca,
+            clearpage_before_voca, large_text, larger_text, tex, templates,
+            deadline=deadline)
+
+    run_xelatex(tex, pdf, quiet=quiet, timeout=time_left(deadline))
 
     return tex, pdf
 
+# Like generate_pdf, but the reader is split at passage and chapter boundaries
+# into chunks of about chunk_verses verses, which are compiled in parallel
+# without page numbers. The chunks are then put together with pdfpages, which
+# adds continuous page numbers. Every chunk starts on a new page.
+def generate_pdf_chunked(passages, include_voca, combine_voca, clearpage_before_voca,
+        large_text, larger_text, tex, pdf, templates, quiet=False, timeout=None,
+        processes=None, chunk_verses=CHUNK_VERSES):
+    deadline = make_deadline(timeout)
+
+    def compile_chunk(fname, chunk_pdf):
+        run_xelatex(fname, chunk_pdf, quiet=quiet, timeout=time_left(deadline))
+
+    # Each chunk is a list of (part, passage, passage_text, show_voca, words)
+    # where passage is the whole (unsplit) passage and words collects its
+    # words.
+    chunks = [[]]
+    chunk_size = 0
+    for passage_text in passages:
+        passage = parse_passage(passage_text)
+        try:
+            parts = split_passage(passage, chunk_verses)
+        except:
+            raise ValueError('Could not find reference "{}"'.format(passage_text))
+        words = set()
+        for i, part in enumerate(parts):
+            size = sum(1 for _ in verses_in_passage(part))
+            if chunk_size > 0 and chunk_size + size > chunk_verses:
+                chunks.append([])
+                chunk_size = 0
+            chunks[-1].append((part, passage, passage_text, i == len(parts)-1, words))
+            chunk_size += size
+
+    directory = tempfile.mkdtemp(prefix='reader', dir=os.path.dirname(pdf) or None)
+    try:
+        voca = set()
+        chunk_files = []
+        for i, chunk in enumerate(chunks):
+            fname = os.path.join(directory, 'chunk{:04d}.tex'.format(i))
+            with open(fname, 'w', encoding='utf-8') as f:
+                write_tex_pre(f, large_text, larger_text, templates)
+                f.write('\\pagestyle{empty}\n')
+                for part, passage, passage_text, show_voca, words in chunk:
+                    check_deadline(deadline)
+                    part_words, _ = write_tex_passage(f, part, passage_text, templates,
+                            title=passage, continued=part['startchap'] != passage['startchap'])
+                    if not include_voca:
+                        continue
+                    words.update(part_words)
+                    if combine_voca:
+                        voca.update(part_words)
+                    elif show_voca:
+                        write_tex_voca(f, render_tex_voca(sorted(words)),
+                                clearpage_before_voca, templates)
+                f.write(templates['post'])
+            chunk_files.append(fname)
+
+        if include_voca and combine_voca:
+            fname = os.path.join(directory, 'chunk{:04d}.tex'.format(len(chunks)))
+            with open(fname, 'w', encoding='utf-8') as f:
+                write_tex_pre(f, large_text, larger_text, templates)
+                f.write('\\pagestyle{empty}\n')
+                write_tex_voca(f, render_tex_voca(sorted(voca), fontsize=''),
+                        False, templates)
+                f.write(templates['post'])
+            chunk_files.append(fname)
+
+        chunk_pdfs = [os.path.splitext(fname)[0] + '.pdf' for fname in chunk_files]
+        with ThreadPoolExecutor(max_workers=processes or os.cpu_count()) as pool:
+            futures = [pool.submit(compile_chunk, fname, chunk_pdf)
+                    for fname, chunk_pdf in zip(chunk_files, chunk_pdfs)]
+            for future in futures:
+                future.result()
+
+        tex.write(templates['preassemble'])
+        for chunk_pdf in chunk_pdfs:
+            tex.write('\\includepdf[pages=-,pagecommand={\\thispagestyle{plain}}]{%s}\n' % chunk_pdf)
+        tex.write(templates['post'])
+        tex.close()
+
+        run_xelatex(tex.name, pdf, quiet=quiet, timeout=time_left(deadline))
+    finally:
+        rmtree(directory, ignore_errors=True)
+
+    return tex.name, pdf
+
 def main():
     parser = ArgumentParser(
             description='LaTeX reader generator for Biblical Hebrew',
@@ -300,12 +808,25 @@ def main():
     p_tex.add_argument('--post-voca-tex', type=FileType('r', encoding='utf-8'),
             metavar='FILE', default=open('postvoca.tex', encoding='utf-8'),
             help='TeX file to append to word list')
+    p_tex.add_argument('--pre-assemble-tex', type=FileType('r', encoding='utf-8'),
+            metavar='FILE', default=open('preassemble.tex', encoding='utf-8'),
+            help='TeX file to prepend to the document that puts together\nthe chunks (with --parallel)')
+
+    p_html = parser.add_argument_group('HTML template options')
+    p_html.add_argument('--pre-html', type=FileType('r', encoding='utf-8'),
+            metavar='FILE', default=open('pre.html', encoding='utf-8'),
+            help='HTML file to prepend to output')
+    p_html.add_argument('--post-html', type=FileType('r', encoding='utf-8'),
+            metavar='FILE', default=open('post.html', encoding='utf-8'),
+            help='HTML file to append to output')
 
     p_output = parser.add_argument_group('Output options')
     p_output.add_argument('--txt', type=FileType('w', encoding='utf-8'),
             metavar='FILE', help='File to write plain text output to')
     p_output.add_argument('--tex', type=FileType('w', encoding='utf-8'),
             metavar='FILE', help='File to write XeLaTeX output to')
+    p_output.add_argument('--html', type=FileType('w', encoding='utf-8'),
+            metavar='FILE', help='File to write HTML output to')
     p_output.add_argument('--pdf',
             metavar='FILE', help='The output PDF file')
 
@@ -318,6 +839,10 @@ def main():
             help='Use one vocabulary list for all passages')
     p_misc.add_argument('--clearpage-before-voca', action='store_true',
             help='Start a new page before vocabulary lists')
+    p_misc.add_argument('--parallel', action='store_true',
+            help='Compile the PDF in chunks in parallel (for large readers;\nevery chunk starts on a new page)')
+    p_misc.add_argument('--processes', type=int, metavar='N',
+            help='Number of parallel XeLaTeX processes with --parallel\n(default: number of CPUs)')
 
     parser.add_argument('passages', metavar='PASSAGE', nargs='*',
             help=textwrap.dedent('''\
@@ -332,8 +857,8 @@ def main():
 
     args = parser.parse_args()
 
-    if args.pdf is None and args.txt is None and args.tex is None:
-        print('At least one of --txt, --tex, or --pdf must be given.')
+    if args.pdf is None and args.txt is None and args.tex is None and args.html is None:
+        print('At least one of --txt, --tex, --html, or --pdf must be given.')
         sys.exit(1)
 
     if args.tex is None and args.pdf is not None:
@@ -353,6 +878,16 @@ def main():
             file = generate_txt(args.passages, args.include_voca, args.combine_voca, args.txt)
             print('Plain text written to', file)
 
+        if args.html is not None:
+            templates = {
+                    'prehtml': args.pre_html.read(),
+                    'posthtml': args.post_html.read(),
+                    }
+            generate_html(args.passages, args.include_voca, args.combine_voca,
+                    args.large_text, False, args.html, templates)
+            args.html.close()
+            print('HTML written to', args.html.name)
+
         templates = {}
         if args.tex is not None:
             templates['pre'] = args.pre_tex.read()
@@ -361,8 +896,16 @@ def main():
             templates['posttext'] = args.post_text_tex.read()
             templates['prevoca'] = args.pre_voca_tex.read()
             templates['postvoca'] = args.post_voca_tex.read()
+            templates['preassemble'] = args.pre_assemble_tex.read()
 
-        if args.pdf is not None:
+        if args.pdf is not None and args.parallel:
+            tex, pdf = generate_pdf_chunked(args.passages, args.include_voca,
+                    args.combine_voca, args.clearpage_before_voca,
+                    args.large_text, False, args.tex, args.pdf, templates,
+                    processes=args.processes)
+            print('XeLaTeX written to', tex)
+            print('PDF written to', pdf)
+        elif args.pdf is not None:
             tex, pdf = generate_pdf(args.passages, args.include_voca,
                     args.combine_voca, args.clearpage_before_voca,
                     args.large_text, False, args.tex, args.pdf, templates)
@@ -1,53 +1,624 @@
 #!/usr/bin/env python3
+from argparse import ArgumentParser
 from contextlib import contextmanager
 import gc
-from http.server import HTTPServer, HTTPStatus, BaseHTTPRequestHandler
+import hmac
+from http.server import ThreadingHTTPServer, HTTPStatus, BaseHTTPRequestHandler
+import io
+import json
+import multiprocessing
 import os
+import queue
 import re
-from shutil import copyfileobj
+from shutil import copyfileobj, rmtree
 import signal
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 from urllib.parse import urlparse, parse_qs
+import uuid
 
 from tf.fabric import Fabric
-from hebrewreader import generate_txt, generate_tex, generate_pdf, load_verse_nodes
+import hebrewreader
+from hebrewreader import generate_txt, generate_tex, generate_pdf, generate_pdf_chunked, \
+        generate_html, \
+        parse_passage, verses_in_passage, count_words, make_deadline, \
+        templates_hash, CONCORDANCE_PAGE_SIZE, use_data, Data, LRUCache, FRAGMENT_CACHE
 
-TEMPLATES = {}
+TEMPLATE_FILES = {
+        'pre': 'pre.tex',
+        'post': 'post.tex',
+        'pretext': 'pretext.tex',
+        'posttext': 'posttext.tex',
+        'prevoca': 'prevoca.tex',
+        'postvoca': 'postvoca.tex',
+        'preassemble': 'preassemble.tex',
+        'prehtml': 'pre.html',
+        'posthtml': 'post.html',
+        }
 
-# https://stackoverflow.com/a/601168/1544337
-class TimeoutException(Exception):
-    pass
+READER_TIME_LIMIT = 10
 
-@contextmanager
-def time_limit(seconds):
-    def signal_handler(signum, frame):
-        raise TimeoutException('Timed out!')
-    signal.signal(signal.SIGALRM, signal_handler)
-    signal.alarm(seconds)
+JOB_DIR = os.path.join(tempfile.gettempdir(), 'hebrewreader-jobs')
+JOB_TIME_LIMIT = 300
+JOB_RETENTION = 3600
+MAX_QUEUED_JOBS = 100
+MAX_QUEUED_JOBS_PER_CLIENT = 5
+
+RESULT_CACHE_SIZE = 64
+
+ACCESS_LOG = 'access.json'
+ACCESS_LOG_SIZE = 1000
+
+PREWARM_COUNT = 20
+PREWARM_IDLE_TIME = 5
+
+# The estimated cost of a reader is (VERSE_COST * verses + words) times the
+# format weight. Requests above MAX_READER_COST are rejected (larger readers
+# can still be built through /jobs, up to MAX_JOB_COST).
+FORMAT_COST = {'txt': 1, 'html': 1, 'tex': 1, 'pdf': 10}
+VERSE_COST = 5
+MAX_READER_COST = 200000
+MAX_JOB_COST = 5000000
+
+# PDFs are built in the TeX lane, everything else in the fast lane. Each lane
+# has a number of slots, a maximum number of slots per client address, and a
+# maximum time to wait for a free slot.
+FAST_LANE_SLOTS = 8
+FAST_LANE_PER_CLIENT = 4
+FAST_LANE_WAIT = 5
+TEX_LANE_SLOTS = 2
+TEX_LANE_PER_CLIENT = 1
+
+# Requests from these addresses (set with --trusted-proxy) are attributed to
+# the client in their X-Forwarded-For header
+TRUSTED_PROXIES = set()
+
+# POST /admin/reload is only available when a token is set (with --admin-token
+# or HEBREWREADER_ADMIN_TOKEN), and must be called with it as bearer token
+ADMIN_TOKEN = None
+
+# Maximum number of XeLaTeX processes for one reader with parallel=1. Each
+# process takes a slot in the TeX lane, so no more than TEX_LANE_SLOTS are used.
+CHUNK_PROCESSES = 4
+
+MAX_CONCORDANCE_PAGE_SIZE = 500
+
+CONTENT_TYPES = {
+        'txt': 'txt/plain',
+        'tex': 'application/x-latex',
+        'html': 'text/html',
+        'pdf': 'application/pdf',
+        }
+
+JOBS = {}
+JOBS_LOCK = threading.Lock()
+JOB_QUEUE = queue.Queue()
+
+# Jobs are built in a separate process. The server is multithreaded, so the
+# processes are not forked from it directly (they could inherit locks held by
+# other threads) but from a fresh forkserver process.
+JOB_CONTEXT = multiprocessing.get_context('forkserver')
+
+RESULT_CACHE = LRUCache(maxsize=RESULT_CACHE_SIZE)
+
+LAST_REQUEST = 0
+
+VERSION = None
+RELOAD_LOCK = threading.Lock()
+
+class RejectedException(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class Lane(object):
+    def __init__(self, slots, per_client, wait):
+        self.slots = slots
+        self.free = slots
+        self.available = threading.Condition()
+        self.per_client = per_client
+        self.wait = wait
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    # A request can take several slots (at most the size of the lane), which
+    # are taken at once.
+    @contextmanager
+    def enter(self, client, wait=None, slots=1):
+        slots = min(slots, self.slots)
+        with self.lock:
+            if self.clients.get(client, 0) >= self.per_client:
+                raise RejectedException(HTTPStatus.TOO_MANY_REQUESTS,
+                        'Too many concurrent requests, please wait for your other readers to finish')
+            self.clients[client] = self.clients.get(client, 0) + 1
+        try:
+            with self.available:
+                if not self.available.wait_for(lambda: self.free >= slots,
+                        timeout=self.wait if wait is None else wait):
+                    raise RejectedException(HTTPStatus.SERVICE_UNAVAILABLE,
+                            'The server is busy, please try again later')
+                self.free -= slots
+            try:
+                yield
+            finally:
+                with self.available:
+                    self.free += slots
+                    self.available.notify_all()
+        finally:
+            with self.lock:
+                self.clients[client] -= 1
+                if self.clients[client] == 0:
+                    del self.clients[client]
+
+FAST_LANE = Lane(FAST_LANE_SLOTS, FAST_LANE_PER_CLIENT, FAST_LANE_WAIT)
+TEX_LANE = Lane(TEX_LANE_SLOTS, TEX_LANE_PER_CLIENT, READER_TIME_LIMIT)
+
+def load_templates():
+    templates = {}
+    for name, fname in TEMPLATE_FILES.items():
+        with open(fname, encoding='utf-8') as f:
+            templates[name] = f.read()
+    return templates
+
+# The data and templates used to generate readers. Requests hold on to the
+# version they started with, so that a reload does not affect them.
+class Version(object):
+    def __init__(self, data, templates):
+        self.data = data
+        self.templates = templates
+        self.key = (data.version, templates_hash(templates))
+
+    def info(self):
+        return {
+                'data': self.data.version,
+                'datadir': self.data.datadir,
+                'templates': self.key[1],
+                }
+
+def reload():
+    global VERSION
+
+    with RELOAD_LOCK:
+        version = Version(Data(), load_templates())
+        VERSION = version
+        hebrewreader.DATA = version.data
+
+    FRAGMENT_CACHE.invalidate(lambda key: key[0] != version.data.version)
+    RESULT_CACHE.invalidate(lambda key: key[0] != version.key)
+    print('Reloaded data version {} and templates version {}'.format(*version.key))
+    return version
+
+def reload_in_background(signum, frame):
+    def run():
+        try:
+            reload()
+        except Exception as e:
+            print('Could not reload: {}'.format(e))
+    threading.Thread(target=run, daemon=True).start()
+
+def parse_reader_args(fmt=['pdf'],
+        include_voca=None, combine_voca=None, clearpage_before_voca=None,
+        text_size=None, parallel=None,
+        passages=None, **kwargs):
+    if passages is None or len(passages) == 0:
+        raise ValueError('No passages given')
+    passages = [p.strip() for ps in passages for p in ps.split('\n') if len(p.strip()) > 0]
+    if len(passages) == 0:
+        raise ValueError('No passages given')
+
+    fmt = fmt[-1]
+    if fmt not in CONTENT_TYPES:
+        raise ValueError('Unknown format')
+
+    return {
+            'fmt': fmt,
+            'passages': passages,
+            'include_voca': include_voca is not None,
+            'combine_voca': combine_voca is not None,
+            'clearpage_before_voca': clearpage_before_voca is not None,
+            'large_text': text_size is not None and int(text_size[0]) > 0,
+            'larger_text': text_size is not None and int(text_size[0]) > 1,
+            'parallel': parallel is not None,
+            }
+
+def format_passage(passage):
+    return '{} {}:{}-{}:{}'.format(
+            passage['book'].replace('_', ' '),
+            passage['startchap'], passage['startverse'],
+            passage['endchap'], passage['endverse'])
+
+# Normalize the request so that equivalent references (e.g. "Jonah" and
+# "Jonah 1-bookend") share cache and access log entries.
+def request_key(args):
+    args = dict(args)
+    args['passages'] = [format_passage(parse_passage(p)) for p in args['passages']]
+    if args['fmt'] in ('txt', 'html'):
+        args['clearpage_before_voca'] = False
+    if args['fmt'] == 'txt':
+        args['large_text'] = args['larger_text'] = False
+    if args['fmt'] != 'pdf':
+        args['parallel'] = False
+    return json.dumps(args, sort_keys=True)
+
+def xelatex_processes(args):
+    if args['fmt'] == 'pdf' and args.get('parallel', False):
+        return min(CHUNK_PROCESSES, TEX_LANE_SLOTS)
+    return 1
+
+def estimate_cost(args):
+    verses = 0
+    words = 0
+    for passage in args['passages']:
+        passage = parse_passage(passage)
+        verses += sum(1 for _ in verses_in_passage(passage))
+        words += count_words(passage)
+    return (VERSE_COST * verses + words) * FORMAT_COST[args['fmt']]
+
+def check_cost(cost, maximum, hint=''):
+    if cost > maximum:
+        raise RejectedException(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                'This reader is too large (estimated cost {}, maximum {}).{}'.format(
+                    cost, maximum, hint))
+
+# Returns the path of the generated file, or for HTML the generated bytes.
+def generate_reader(args, templates, directory=None, timeout=None):
+    fmt = args['fmt']
+    deadline = make_deadline(timeout)
+    if fmt == 'txt':
+        txt = tempfile.mkstemp(suffix='.txt', prefix='reader', dir=directory)
+        txt = open(txt[1], 'w', encoding='utf-8')
+        return generate_txt(args['passages'],
+                args['include_voca'], args['combine_voca'],
+                txt, deadline=deadline)
+    elif fmt == 'tex':
+        tex = tempfile.mkstemp(suffix='.tex', prefix='reader', dir=directory)
+        tex = open(tex[1], 'w', encoding='utf-8')
+        return generate_tex(args['passages'],
+                args['include_voca'], args['combine_voca'],
+                args['clearpage_before_voca'],
+                args['large_text'], args['larger_text'],
+                tex,
+                templates, deadline=deadline)
+    elif fmt == 'html':
+        html = generate_html(args['passages'],
+                args['include_voca'], args['combine_voca'],
+                args['large_text'], args['larger_text'],
+                io.StringIO(),
+                templates, deadline=deadline)
+        return html.getvalue().encode('utf-8')
+    elif fmt == 'pdf':
+        tex = tempfile.mkstemp(suffix='.tex', prefix='reader', dir=directory)
+        tex = open(tex[1], 'w', encoding='utf-8')
+        pdf = tempfile.mkstemp(suffix='.pdf', prefix='reader', dir=directory)[1]
+        if args.get('parallel', False):
+            _, output = generate_pdf_chunked(args['passages'],
+                    args['include_voca'], args['combine_voca'],
+                    args['clearpage_before_voca'],
+                    args['large_text'], args['larger_text'],
+                    tex, pdf,
+                    templates, quiet=True, timeout=timeout,
+                    processes=xelatex_processes(args))
+            return output
+        _, output = generate_pdf(args['passages'],
+                args['include_voca'], args['combine_voca'],
+                args['clearpage_before_voca'],
+                args['large_text'], args['larger_text'],
+                tex, pdf,
+                templates, quiet=True, timeout=timeout)
+        return output
+    else:
+        raise ValueError('Unknown format')
+
+def load_output(output):
+    if isinstance(output, bytes):
+        return output
+    with open(output, 'rb') as f:
+        return f.read()
+
+class AccessLog(object):
+    def __init__(self, fname, maxsize):
+        self.fname = fname
+        self.maxsize = maxsize
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.fname, encoding='utf-8') as f:
+                self.counts = json.load(f)
+        except (OSError, ValueError):
+            self.counts = {}
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            counts = dict(self.counts)
+            self.dirty = False
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(counts, f)
+        os.replace(tmp, self.fname)
+
+    def record(self, key):
+        with self.lock:
+            count = self.counts.get(key, 0) + 1
+            self.counts[key] = count
+            self.dirty = True
+            if len(self.counts) > self.maxsize:
+                keep = sorted(self.counts.items(), key=lambda kv: -kv[1])
+                self.counts = dict(keep[:self.maxsize // 2])
+                self.counts[key] = count
+
+    def top(self, n):
+        with self.lock:
+            return [key for key, _ in
+                    sorted(self.counts.items(), key=lambda kv: -kv[1])[:n]]
+
+ACCESS = AccessLog(ACCESS_LOG, ACCESS_LOG_SIZE)
+
+def save_access_log():
+    try:
+        ACCESS.save()
+    except OSError as e:
+        print('Could not save access log: {}'.format(e))
+
+def wait_until_idle():
+    while time.time() - LAST_REQUEST < PREWARM_IDLE_TIME:
+        time.sleep(1)
+
+def prewarm_worker():
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+    while True:
+        wait_until_idle()
+        for key in ACCESS.top(PREWARM_COUNT):
+            version = VERSION
+            if (version.key, key) in RESULT_CACHE:
+                continue
+            wait_until_idle()
+            try:
+                args = json.loads(key)
+                # Parallel readers would take several slots of the TeX lane
+                if xelatex_processes(args) > 1:
+                    continue
+                # Only use a free slot, so that live requests do not have to
+                # wait for prewarming; if there is none, try again next round
+                lane = TEX_LANE if args['fmt'] == 'pdf' else FAST_LANE
+                with lane.enter('prewarm', wait=0), use_data(version.data):
+                    output = generate_reader(args, version.templates,
+                            timeout=READER_TIME_LIMIT)
+                if version is VERSION:
+                    RESULT_CACHE.put((version.key, key), load_output(output))
+            except RejectedException:
+                continue
+            except Exception as e:
+                print('Could not prewarm {}: {}'.format(key, e))
+        save_access_log()
+        time.sleep(PREWARM_IDLE_TIME)
+
+class Job(object):
+    def __init__(self, args, cost, client):
+        self.id = uuid.uuid4().hex
+        self.args = args
+        self.cost = cost
+        self.client = client
+        self.status = 'queued'
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.directory = os.path.join(JOB_DIR, self.id)
+        self.output = os.path.join(self.directory, 'reader.' + args['fmt'])
+
+    def info(self):
+        info = {
+                'id': self.id,
+                'status': self.status,
+                'format': self.args['fmt'],
+                'estimated_cost': self.cost,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+                'status_url': '/jobs/{}'.format(self.id),
+                }
+        if self.error is not None:
+            info['error'] = self.error
+        if self.status == 'done':
+            info['download_url'] = '/jobs/{}/download'.format(self.id)
+            info['expires'] = self.finished + JOB_RETENTION
+        return info
+
+def build_job(job, version, conn):
+    os.setpgrp()
     try:
-        yield
+        with use_data(version.data):
+            output = generate_reader(job.args, version.templates, directory=job.directory)
+        if isinstance(output, bytes):
+            with open(job.output, 'wb') as f:
+                f.write(output)
+        else:
+            os.replace(output, job.output)
+        conn.send(None)
+    except Exception as e:
+        conn.send(str(e))
     finally:
-        signal.alarm(0)
+        conn.close()
+
+def run_job(job, version):
+    os.makedirs(job.directory, exist_ok=True)
+    job.status = 'running'
+    job.started = time.time()
+
+    recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+    process = JOB_CONTEXT.Process(
+            target=build_job, args=(job, version, send_conn), daemon=True)
+    process.start()
+    send_conn.close()
+    process.join(JOB_TIME_LIMIT)
+
+    if process.is_alive():
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.join()
+        job.status = 'timeout'
+        job.error = 'Timed out!'
+    elif recv_conn.poll():
+        error = recv_conn.recv()
+        if error is None and os.path.isfile(job.output):
+            job.status = 'done'
+        else:
+            job.status = 'failed'
+            job.error = error
+    else:
+        job.status = 'failed'
+        job.error = 'Build process exited unexpectedly'
+
+    recv_conn.close()
+    job.finished = time.time()
+
+def remove_job_files(job):
+    rmtree(job.directory, ignore_errors=True)
+
+def purge_jobs():
+    now = time.time()
+    with JOBS_LOCK:
+        expired = [job for job in JOBS.values()
+                if job.finished is not None and job.finished + JOB_RETENTION < now]
+        for job in expired:
+            del JOBS[job.id]
+    for job in expired:
+        remove_job_files(job)
+    purge_orphaned_jobs()
+
+# Remove files of jobs that are not known to this process (e.g. left behind by
+# a previous server process) once they are older than JOB_RETENTION.
+def purge_orphaned_jobs():
+    now = time.time()
+    with JOBS_LOCK:
+        known = set(JOBS)
+    try:
+        entries = os.listdir(JOB_DIR)
+    except OSError:
+        return
+    for entry in entries:
+        path = os.path.join(JOB_DIR, entry)
+        try:
+            if entry not in known and os.stat(path).st_mtime + JOB_RETENTION < now:
+                rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+def job_worker():
+    while True:
+        try:
+            job = JOB_QUEUE.get(timeout=60)
+        except queue.Empty:
+            purge_jobs()
+            continue
+        try:
+            run_job(job, VERSION)
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            job.finished = time.time()
+        purge_jobs()
 
 class HTTPRequestHandler(BaseHTTPRequestHandler):
+    # The message can contain user input, so it is only sent in the body and
+    # not as the reason phrase.
     def send_quick_response(self, status, message):
-        self.send_response(status, message)
+        content = bytes(message, 'utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_json(self, status, data):
+        content = bytes(json.dumps(data), 'utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
         self.end_headers()
-        self.wfile.write(bytes(message, 'utf-8'))
+        self.wfile.write(content)
+
+    # The client address used for the per-client limits of the lanes. Behind
+    # trusted proxies, this is the last address in X-Forwarded-For that was
+    # not added by a trusted proxy.
+    def client_key(self):
+        client = self.client_address[0]
+        if client in TRUSTED_PROXIES:
+            forwarded = self.headers.get('X-Forwarded-For', '').split(',')
+            for address in reversed([a.strip() for a in forwarded if a.strip() != '']):
+                client = address
+                if address not in TRUSTED_PROXIES:
+                    break
+        return client
 
     def do_GET(self):
+        global LAST_REQUEST
+        LAST_REQUEST = time.time()
+
+        self.version = VERSION
+        with use_data(self.version.data):
+            self.handle_GET()
+
+    def handle_GET(self):
         req = urlparse('http://localhost' + self.path)
         if req.path == '/':
             self.do_send_file('index.html')
         elif req.path == '/reader':
             self.do_generate_reader(**parse_qs(req.query, keep_blank_values=True))
             gc.collect()
+        elif req.path == '/stats':
+            self.send_json(HTTPStatus.OK, {
+                'fragment_cache': FRAGMENT_CACHE.stats(),
+                'result_cache': RESULT_CACHE.stats(),
+                'version': VERSION.info(),
+                })
+        elif req.path == '/concordance':
+            self.do_concordance(**parse_qs(req.query))
+        elif re.match(r'^\/jobs\/\w+$', req.path):
+            self.do_job_status(req.path.split('/')[2])
+        elif re.match(r'^\/jobs\/\w+\/download$', req.path):
+            self.do_job_download(req.path.split('/')[2])
         elif re.match(r'^\/\.well-known\/acme-challenge\/\w*$', req.path) and \
                 os.path.isfile(req.path[1:]):
             self.do_send_file(req.path[1:])
         else:
             self.send_quick_response(HTTPStatus.NOT_FOUND, 'Not found')
 
+    def do_POST(self):
+        global LAST_REQUEST
+        LAST_REQUEST = time.time()
+
+        self.version = VERSION
+        with use_data(self.version.data):
+            self.handle_POST()
+
+    def handle_POST(self):
+        req = urlparse('http://localhost' + self.path)
+        if req.path == '/admin/reload':
+            self.do_reload()
+        elif req.path == '/jobs':
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length).decode('utf-8')
+            query = parse_qs(req.query, keep_blank_values=True)
+            query.update(parse_qs(body, keep_blank_values=True))
+            self.do_create_job(**query)
+        else:
+            self.send_quick_response(HTTPStatus.NOT_FOUND, 'Not found')
+
     def do_send_file(self, fname):
         self.send_response(HTTPStatus.OK, 'OK')
         self.send_header('Content-Type', 'text/html; charset=utf-8')
@@ -55,88 +626,202 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         with open(fname, 'rb') as f:
             copyfileobj(f, self.wfile)
 
-    def do_generate_reader(self, fmt=['pdf'],
-            include_voca=None, combine_voca=None, clearpage_before_voca=None,
-            text_size=None,
-            passages=None, **kwargs):
-        if passages is None or len(passages) == 0:
-            self.send_quick_response(HTTPStatus.BAD_REQUEST, 'No passages given')
+    def do_generate_reader(self, **kwargs):
+        try:
+            args = parse_reader_args(**kwargs)
+            key = request_key(args)
+        except ValueError as e:
+            self.send_quick_response(HTTPStatus.BAD_REQUEST, str(e))
             return
-        passages = [p.strip() for ps in passages for p in ps.split('\n') if len(p.strip()) > 0]
 
-        fmt = fmt[-1]
+        fmt = args['fmt']
 
-        try:
-            with time_limit(10):
-                if fmt == 'txt':
-                    txt = tempfile.mkstemp(suffix='.txt', prefix='reader')
-                    txt = open(txt[1], 'w', encoding='utf-8')
-                    output = generate_txt(passages,
-                            include_voca is not None and include_voca,
-                            combine_voca is not None and combine_voca,
-                            txt)
-                    content_type = 'txt/plain'
-                elif fmt == 'tex':
-                    tex = tempfile.mkstemp(suffix='.tex', prefix='reader')
-                    tex = open(tex[1], 'w', encoding='utf-8')
-                    output = generate_tex(passages,
-                            include_voca is not None and include_voca,
-                            combine_voca is not None and combine_voca,
-                            clearpage_before_voca is not None and clearpage_before_voca,
-                            text_size is not None and int(text_size[0]) > 0,
-                            text_size is not None and int(text_size[0]) > 1,
-                            tex,
-                            TEMPLATES)
-                    content_type = 'application/x-latex'
-                elif fmt == 'pdf':
-                    tex = tempfile.mkstemp(suffix='.tex', prefix='reader')
-                    tex = open(tex[1], 'w', encoding='utf-8')
-                    pdf = tempfile.mkstemp(suffix='.pdf', prefix='reader')[1]
-                    _, output = generate_pdf(passages,
-                            include_voca is not None and include_voca,
-                            combine_voca is not None and combine_voca,
-                            clearpage_before_voca is not None and clearpage_before_voca,
-                            text_size is not None and int(text_size[0]) > 0,
-                            text_size is not None and int(text_size[0]) > 1,
-                            tex, pdf,
-                            TEMPLATES, quiet=True)
-                    content_type = 'application/pdf'
-                else:
-                    self.send_quick_response(HTTPStatus.BAD_REQUEST, 'Unknown format')
-                    return
-        except TimeoutException as e:
-            self.send_quick_response(HTTPStatus.REQUEST_TIMEOUT, str(e))
+        version = self.version
+        content = RESULT_CACHE.get((version.key, key))
+        if content is None:
+            deadline = time.time() + READER_TIME_LIMIT
+            lane = TEX_LANE if fmt == 'pdf' else FAST_LANE
+            try:
+                check_cost(estimate_cost(args), MAX_READER_COST,
+                        ' Use fewer passages, or generate it in the background through /jobs.')
+                with lane.enter(self.client_key(), wait=max(deadline - time.time(), 0),
+                        slots=xelatex_processes(args)):
+                    timeout = max(deadline - time.time(), 0)
+                    content = load_output(generate_reader(args, version.templates, timeout=timeout))
+            except RejectedException as e:
+                self.send_quick_response(e.status, str(e))
+                return
+            except (subprocess.TimeoutExpired, TimeoutError):
+                self.send_quick_response(HTTPStatus.REQUEST_TIMEOUT, 'Timed out!')
+                return
+            except Exception as e:
+                self.send_quick_response(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+                return
+            if version is VERSION:
+                RESULT_CACHE.put((version.key, key), content)
+
+        ACCESS.record(key)
+
+        disposition = 'inline' if fmt == 'html' else 'attachment'
+        self.send_response(HTTPStatus.OK, 'OK')
+        self.send_header('Content-Type', '{}; charset=utf-8'.format(CONTENT_TYPES[fmt]))
+        self.send_header('Content-Disposition', '{}; filename=reader.{}'.format(disposition, fmt))
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_reload(self):
+        if ADMIN_TOKEN is None:
+            self.send_quick_response(HTTPStatus.NOT_FOUND, 'Not found')
+            return
+        token = self.headers.get('Authorization', '')
+        if not hmac.compare_digest(token.encode('utf-8'), 'Bearer {}'.format(ADMIN_TOKEN).encode('utf-8')):
+            self.send_quick_response(HTTPStatus.FORBIDDEN, 'Forbidden')
             return
+        try:
+            version = reload()
         except Exception as e:
             self.send_quick_response(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
             return
+        self.send_json(HTTPStatus.OK, version.info())
+
+    def do_concordance(self, lex=None, book=None, page=['1'], page_size=None, **kwargs):
+        concordance = self.version.data.concordance
+        if concordance is None:
+            self.send_json(HTTPStatus.SERVICE_UNAVAILABLE,
+                    {'error': 'No concordance available'})
+            return
+
+        # Errors go in the body, because the lexeme and book may contain
+        # characters that cannot be put in the status line
+        if lex is None:
+            self.send_json(HTTPStatus.BAD_REQUEST, {'error': 'No lexeme given'})
+            return
+        try:
+            page = int(page[0])
+            page_size = CONCORDANCE_PAGE_SIZE if page_size is None else int(page_size[0])
+        except ValueError:
+            page = page_size = 0
+        if page < 1 or not 0 < page_size <= MAX_CONCORDANCE_PAGE_SIZE:
+            self.send_json(HTTPStatus.BAD_REQUEST, {'error': 'Invalid page or page size'})
+            return
+
+        try:
+            result = concordance.search(lex[0],
+                    book=None if book is None else book[0],
+                    page=page, page_size=page_size)
+        except KeyError:
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': 'Unknown lexeme'})
+            return
+        except ValueError as e:
+            self.send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+            return
+
+        self.send_json(HTTPStatus.OK, result)
+
+    def do_create_job(self, **kwargs):
+        try:
+            args = parse_reader_args(**kwargs)
+            cost = estimate_cost(args)
+        except ValueError as e:
+            self.send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+            return
+
+        try:
+            check_cost(cost, MAX_JOB_COST)
+        except RejectedException as e:
+            self.send_json(e.status, {'error': str(e)})
+            return
+
+        if JOB_QUEUE.qsize() >= MAX_QUEUED_JOBS:
+            self.send_json(HTTPStatus.SERVICE_UNAVAILABLE, {'error': 'Too many queued jobs'})
+            return
+
+        job = Job(args, cost, self.client_key())
+        with JOBS_LOCK:
+            pending = sum(1 for other in JOBS.values()
+                    if other.client == job.client and other.status in ('queued', 'running'))
+            if pending < MAX_QUEUED_JOBS_PER_CLIENT:
+                JOBS[job.id] = job
+        if pending >= MAX_QUEUED_JOBS_PER_CLIENT:
+            self.send_json(HTTPStatus.TOO_MANY_REQUESTS,
+                    {'error': 'Too many queued jobs, please wait for your other readers to finish'})
+            return
+        JOB_QUEUE.put(job)
 
-        filename = 'reader.' + fmt
+        self.send_json(HTTPStatus.ACCEPTED, job.info())
 
-        with open(output, 'rb') as f:
+    def do_job_status(self, job_id):
+        with JOBS_LOCK:
+            job = JOBS.get(job_id)
+        if job is None:
+            self.send_quick_response(HTTPStatus.NOT_FOUND, 'Not found')
+            return
+        self.send_json(HTTPStatus.OK, job.info())
+
+    def do_job_download(self, job_id):
+        with JOBS_LOCK:
+            job = JOBS.get(job_id)
+        if job is None:
+            self.send_quick_response(HTTPStatus.NOT_FOUND, 'Not found')
+            return
+        if job.status != 'done':
+            self.send_quick_response(HTTPStatus.CONFLICT, 'Job is {}'.format(job.status))
+            return
+
+        fmt = job.args['fmt']
+        with open(job.output, 'rb') as f:
             self.send_response(HTTPStatus.OK, 'OK')
-            self.send_header('Content-Type', '{}; charset=utf-8'.format(content_type))
-            self.send_header('Content-Disposition', 'attachment; filename={}'.format(filename))
+            self.send_header('Content-Type', '{}; charset=utf-8'.format(CONTENT_TYPES[fmt]))
+            self.send_header('Content-Disposition', 'attachment; filename=reader.{}'.format(fmt))
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
             self.end_headers()
             copyfileobj(f, self.wfile)
-            return
-
-        self.send_quick_response(HTTPStatus.NOT_FOUND, 'Not found')
 
 def main():
-    TEMPLATES['pre'] = open('pre.tex', encoding='utf-8').read()
-    TEMPLATES['post'] = open('post.tex', encoding='utf-8').read()
-    TEMPLATES['pretext'] = open('pretext.tex', encoding='utf-8').read()
-    TEMPLATES['posttext'] = open('posttext.tex', encoding='utf-8').read()
-    TEMPLATES['prevoca'] = open('prevoca.tex', encoding='utf-8').read()
-    TEMPLATES['postvoca'] = open('postvoca.tex', encoding='utf-8').read()
-
-    load_verse_nodes()
-
-    print('Listening on port 19419...')
-    address = ('', 19419)
-    httpd = HTTPServer(address, HTTPRequestHandler)
-    httpd.serve_forever()
+    global MAX_READER_COST
+    global MAX_JOB_COST
+    global ADMIN_TOKEN
+
+    parser = ArgumentParser(description='HTTP server for the Biblical Hebrew reader generator')
+    parser.add_argument('--port', type=int, default=19419,
+            help='Port to listen on')
+    parser.add_argument('--max-cost', type=int, default=MAX_READER_COST,
+            help='Reject /reader requests with a higher estimated cost')
+    parser.add_argument('--max-job-cost', type=int, default=MAX_JOB_COST,
+            help='Reject /jobs requests with a higher estimated cost')
+    parser.add_argument('--trusted-proxy', action='append', default=[], metavar='ADDRESS',
+            help='Use X-Forwarded-For to identify clients of this proxy (can be repeated)')
+    parser.add_argument('--admin-token', default=os.environ.get('HEBREWREADER_ADMIN_TOKEN'),
+            help='Enable POST /admin/reload for requests with this bearer token')
+    args = parser.parse_args()
+    ADMIN_TOKEN = args.admin_token or None
+    MAX_READER_COST = args.max_cost
+    MAX_JOB_COST = args.max_job_cost
+    TRUSTED_PROXIES.update(args.trusted_proxy)
+
+    reload()
+    signal.signal(signal.SIGHUP, reload_in_background)
+
+    os.makedirs(JOB_DIR, exist_ok=True)
+    purge_orphaned_jobs()
+    JOB_CONTEXT.set_forkserver_preload(['hebrewreader'])
+    threading.Thread(target=job_worker, daemon=True).start()
+
+    ACCESS.load()
+    threading.Thread(target=prewarm_worker, daemon=True).start()
+
+    print('Listening on port {}...'.format(args.port))
+    address = ('', args.port)
+    httpd = ThreadingHTTPServer(address, HTTPRequestHandler)
+    httpd.daemon_threads = True
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        save_access_log()
 
 if __name__ == '__main__':
     main()
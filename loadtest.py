@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import pickle
+import random
+from shutil import copyfile
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+# Passages by size class. With --synthetic, the same books are generated so
+# that the mix works for both the real and the synthetic data set.
+PASSAGES = {
+        'verse': ['Genesis 1:1', 'Psalms 23:1', 'Jonah 1:3', 'Ruth 1:16'],
+        'chapter': ['Genesis 1', 'Psalms 1', 'Psalms 23', 'Jonah 1', 'Ruth 2'],
+        'book': ['Jonah', 'Ruth'],
+        'large': ['Genesis', 'Psalms'],
+        }
+
+SYNTHETIC_BOOKS = {'Genesis': 50, 'Psalms': 150, 'Jonah': 4, 'Ruth': 4}
+SYNTHETIC_VERSES = 25
+SYNTHETIC_WORDS = 15
+SYNTHETIC_LEXEMES = 2000
+
+TEMPLATE_FILES = ['pre.tex', 'post.tex', 'pretext.tex', 'posttext.tex',
+        'prevoca.tex', 'postvoca.tex', 'preassemble.tex', 'pre.html', 'post.html',
+        'index.html']
+
+STUB_XELATEX = '''#!/bin/sh
+# Stub xelatex for load tests: copies the TeX source to the output PDF.
+dir=.
+while [ $# -gt 1 ]; do
+	case "$1" in
+		-output-directory) dir=$2; shift 2;;
+		-jobname) job=$2; shift 2;;
+		*) shift;;
+	esac
+done
+sleep {latency}
+cp "$1" "$dir/$job.pdf"
+'''
+
+def parse_weights(spec, allowed):
+    weights = {}
+    for item in spec.split(','):
+        name, weight = item.split('=')
+        if name not in allowed:
+            raise ValueError('Unknown value "{}" (expected one of {})'.format(
+                name, ', '.join(sorted(allowed))))
+        weights[name] = float(weight)
+    return weights
+
+def choose(weights):
+    return random.choices(list(weights), weights=list(weights.values()))[0]
+
+def make_synthetic_chapter(first_node, lexemes):
+    features = {f: {} for f in
+            ('otype', 'g_word_utf8', 'trailer_utf8', 'lex_utf8', 'voc_lex_utf8', 'gloss')}
+    locality = {'u': {}, 'd': {}, 'n': {}, 'p': {}}
+    verse_nodes = {}
+    verse_words = {}
+    nodes = []
+
+    node = first_node
+    for verse in range(1, SYNTHETIC_VERSES + 1):
+        vnode = node
+        node += 1
+        verse_nodes[verse] = vnode
+        verse_words[verse] = SYNTHETIC_WORDS
+        features['otype'][vnode] = 'verse'
+        words = tuple(range(node, node + SYNTHETIC_WORDS))
+        node += SYNTHETIC_WORDS
+        locality['d'][vnode] = words
+        nodes.append(vnode)
+        for i, word in enumerate(words):
+            lex = random.randrange(SYNTHETIC_LEXEMES)
+            lnode = lexemes[lex]
+            features['otype'][word] = 'word'
+            features['g_word_utf8'][word] = 'מלה{}'.format(word % 1000)
+            features['trailer_utf8'][word] = '׃ ס ' if i == SYNTHETIC_WORDS - 1 else ' '
+            features['lex_utf8'][word] = 'ל{}'.format(lex)
+            features['otype'][lnode] = 'lex'
+            features['voc_lex_utf8'][lnode] = 'לקס{}'.format(lex)
+            features['gloss'][lnode] = 'gloss {}'.format(lex)
+            locality['u'][word] = (vnode, lnode)
+            nodes.append(word)
+            nodes.append(lnode)
+
+    context = dict(
+            nodes=','.join(str(n) for n in sorted(set(nodes))),
+            features=features,
+            featureType={f: 0 for f in features},
+            locality=locality,
+            text={},
+            langs=set())
+    return context, verse_nodes, verse_words, node
+
+def make_synthetic(directory, latency):
+    datadir = os.path.join(directory, 'data')
+    os.makedirs(datadir, exist_ok=True)
+
+    # lexeme nodes come after all other nodes
+    total_nodes = sum(SYNTHETIC_BOOKS.values()) * SYNTHETIC_VERSES * (SYNTHETIC_WORDS + 1)
+    lexemes = [total_nodes + 1 + i for i in range(SYNTHETIC_LEXEMES)]
+
+    verse_nodes = {}
+    verse_words = {}
+    node = 1
+    for book, chapters in SYNTHETIC_BOOKS.items():
+        verse_nodes[book] = {}
+        verse_words[book] = {}
+        for chap in range(1, chapters + 1):
+            context, verse_nodes[book][chap], verse_words[book][chap], node = \
+                    make_synthetic_chapter(node, lexemes)
+            with open(os.path.join(datadir, '{}_{}.pkl'.format(book, chap)), 'wb') as f:
+                pickle.dump(context, f)
+
+    with open(os.path.join(datadir, 'verse_nodes.pkl'), 'wb') as f:
+        pickle.dump(verse_nodes, f)
+    with open(os.path.join(datadir, 'verse_words.pkl'), 'wb') as f:
+        pickle.dump(verse_words, f)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    for fname in TEMPLATE_FILES:
+        copyfile(os.path.join(here, fname), os.path.join(directory, fname))
+
+    bindir = os.path.join(directory, 'bin')
+    os.makedirs(bindir, exist_ok=True)
+    xelatex = os.path.join(bindir, 'xelatex')
+    with open(xelatex, 'w') as f:
+        f.write(STUB_XELATEX.replace('{latency}', str(latency)))
+    os.chmod(xelatex, 0o755)
+
+def start_server(directory, port, stub_xelatex, clients):
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = here + os.pathsep + env.get('PYTHONPATH', '')
+    if stub_xelatex:
+        env['PATH'] = os.path.join(os.path.abspath(directory), 'bin') + os.pathsep + env['PATH']
+    cmd = [sys.executable, os.path.join(here, 'hebrewreaderserver.py'), '--port', str(port)]
+    if clients > 0:
+        cmd += ['--trusted-proxy', '127.0.0.1', '--trusted-proxy', '::1']
+    server = subprocess.Popen(cmd,
+            cwd=directory, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for _ in range(600):
+        if server.poll() is not None:
+            raise RuntimeError('The server exited with status {}'.format(server.returncode))
+        try:
+            with socket.create_connection(('localhost', port), timeout=1):
+                return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('The server did not start')
+
+def read_rss(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+class LoadTest(object):
+    def __init__(self, url, formats, sizes, option_probability, timeout, clients):
+        self.url = url.rstrip('/')
+        self.clients = clients
+        self.formats = formats
+        self.sizes = sizes
+        self.option_probability = option_probability
+        self.timeout = timeout
+        self.results = []
+        self.rss = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def make_request(self):
+        size = choose(self.sizes)
+        query = [
+                ('fmt', choose(self.formats)),
+                ('passages', random.choice(PASSAGES[size])),
+                ('text_size', str(random.choice([0, 0, 0, 1, 2]))),
+                ]
+        for option in ('include_voca', 'combine_voca', 'clearpage_before_voca'):
+            if random.random() < self.option_probability:
+                query.append((option, 'on'))
+        headers = {}
+        if self.clients > 0:
+            client = random.randrange(self.clients)
+            headers['X-Forwarded-For'] = '10.0.{}.{}'.format(client // 256, client % 256)
+        return size, Request(self.url + '/reader?' + urlencode(query), headers=headers)
+
+    def request(self):
+        size, request = self.make_request()
+        start = time.time()
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                response.read()
+                status = response.status
+        except HTTPError as e:
+            status = e.code
+        except (socket.timeout, TimeoutError):
+            status = 'timeout'
+        except URLError as e:
+            status = 'timeout' if isinstance(e.reason, socket.timeout) else 'error'
+        except OSError:
+            status = 'error'
+        end = time.time()
+        with self.lock:
+            self.results.append((start, end - start, size, status))
+
+    def sample_rss(self, pid, interval):
+        start = time.time()
+        while not self.stopped.wait(interval):
+            rss = read_rss(pid)
+            if rss is not None:
+                self.rss.append((time.time() - start, rss))
+
+    def run_closed(self, concurrency, duration):
+        def worker():
+            while not self.stopped.is_set():
+                self.request()
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        self.stopped.set()
+        for thread in threads:
+            thread.join()
+
+    def run_open(self, rate, duration):
+        deadline = time.time() + duration
+        with ThreadPoolExecutor(max_workers=1000) as pool:
+            while time.time() < deadline:
+                pool.submit(self.request)
+                time.sleep(random.expovariate(rate))
+            self.stopped.set()
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def report(test, duration):
+    results = test.results
+    latencies = [latency for (_, latency, _, status) in results if status == 200]
+    statuses = {}
+    for (_, _, _, status) in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(n for (status, n) in statuses.items() if status != '200')
+    timeouts = statuses.get('timeout', 0) + statuses.get('408', 0)
+
+    summary = {
+            'requests': len(results),
+            'duration': duration,
+            'throughput': len(results) / duration,
+            'latency': {
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'max': max(latencies, default=float('nan')),
+                },
+            'error_rate': errors / len(results) if results else 0.0,
+            'timeout_rate': timeouts / len(results) if results else 0.0,
+            'statuses': statuses,
+            'latency_by_size': {
+                size: {
+                    'p50': percentile([l for (_, l, s, st) in results if s == size and st == 200], 50),
+                    'p95': percentile([l for (_, l, s, st) in results if s == size and st == 200], 95),
+                    }
+                for size in sorted({s for (_, _, s, _) in results})},
+            'rss': test.rss,
+            }
+
+    print('Requests:     {} in {:.1f}s ({:.2f} req/s)'.format(
+        summary['requests'], duration, summary['throughput']))
+    print('Latency:      p50 {p50:.3f}s, p95 {p95:.3f}s, p99 {p99:.3f}s, max {max:.3f}s'.format(
+        **summary['latency']))
+    for size, latency in summary['latency_by_size'].items():
+        print('  {:10}  p50 {p50:.3f}s, p95 {p95:.3f}s'.format(size, **latency))
+    print('Errors:       {:.1%} (timeouts: {:.1%})'.format(
+        summary['error_rate'], summary['timeout_rate']))
+    print('Statuses:     {}'.format(', '.join(
+        '{}: {}'.format(status, n) for (status, n) in sorted(statuses.items()))))
+    if len(test.rss) > 0:
+        print('Server RSS:   {:.1f} MiB at start, {:.1f} MiB at end, {:.1f} MiB max'.format(
+            test.rss[0][1] / 2**20, test.rss[-1][1] / 2**20,
+            max(rss for (_, rss) in test.rss) / 2**20))
+        step = max(1, len(test.rss) // 10)
+        print('              ' + ' '.join(
+            '{:.0f}s:{:.0f}'.format(t, rss / 2**20) for (t, rss) in test.rss[::step]))
+
+    return summary
+
+def main():
+    parser = ArgumentParser(description='Replay a mix of reader requests against the HTTP server')
+
+    p_server = parser.add_argument_group('Server options')
+    p_server.add_argument('--url', default='http://localhost:19419',
+            help='Server to test (default: %(default)s)')
+    p_server.add_argument('--server-pid', type=int,
+            help='PID of the server, to record its memory usage')
+    p_server.add_argument('--synthetic', metavar='DIR',
+            help='Generate a synthetic data set in DIR and start a server on it')
+    p_server.add_argument('--real-xelatex', action='store_true',
+            help='With --synthetic, use the real xelatex instead of a stub')
+    p_server.add_argument('--stub-latency', type=float, default=1.0,
+            help='Time the stub xelatex takes per PDF (default: %(default)s)')
+    p_server.add_argument('--port', type=int, default=19420,
+            help='Port for the server started with --synthetic (default: %(default)s)')
+
+    p_mix = parser.add_argument_group('Request mix')
+    p_mix.add_argument('--formats', default='pdf=2,html=2,txt=1,tex=1',
+            help='Weights of the output formats (default: %(default)s)')
+    p_mix.add_argument('--sizes', default='verse=3,chapter=5,book=1,large=0.2',
+            help='Weights of the passage sizes (default: %(default)s)')
+    p_mix.add_argument('--option-probability', type=float, default=0.5,
+            help='Probability of setting each vocabulary option (default: %(default)s)')
+
+    p_load = parser.add_argument_group('Load options')
+    p_load.add_argument('--concurrency', type=int, default=10,
+            help='Number of concurrent clients (default: %(default)s)')
+    p_load.add_argument('--rate', type=float,
+            help='Send requests at this average rate per second instead of with a fixed concurrency')
+    p_load.add_argument('--duration', type=float, default=30,
+            help='Duration of the test in seconds (default: %(default)s)')
+    p_load.add_argument('--clients', type=int, default=100,
+            help='Number of client addresses to simulate with X-Forwarded-For; 0 sends '
+            'all requests from the same address (default: %(default)s)')
+    p_load.add_argument('--timeout', type=float, default=30,
+            help='Client timeout in seconds (default: %(default)s)')
+    p_load.add_argument('--seed', type=int, help='Random seed')
+    p_load.add_argument('--json', metavar='FILE', help='Also write the results to FILE')
+
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    try:
+        formats = parse_weights(args.formats, {'pdf', 'html', 'txt', 'tex'})
+        sizes = parse_weights(args.sizes, set(PASSAGES))
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    server = None
+    url = args.url
+    pid = args.server_pid
+    if args.synthetic is not None:
+        print('Generating synthetic data in {}...'.format(args.synthetic))
+        make_synthetic(args.synthetic, args.stub_latency)
+        server = start_server(args.synthetic, args.port, not args.real_xelatex, args.clients)
+        url = 'http://localhost:{}'.format(args.port)
+        pid = server.pid
+
+    test = LoadTest(url, formats, sizes, args.option_probability, args.timeout, args.clients)
+    if pid is not None:
+        threading.Thread(target=test.sample_rss, args=(pid, 1), daemon=True).start()
+
+    print('Running load test against {}...'.format(url))
+    start = time.time()
+    try:
+        if args.rate is not None:
+            test.run_open(args.rate, args.duration)
+        else:
+            test.run_closed(args.concurrency, args.duration)
+    finally:
+        test.stopped.set()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    summary = report(test, time.time() - start)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,12 @@
 from functools import reduce
+from itertools import chain, compress
+
+import numpy as np
 
 from tf.core.api import NodeFeature, EdgeFeature
 
+LOCALITY_CACHE_MIN = 32
+
 class MiniApi(object):
     def __init__(
             self,
@@ -111,37 +116,7 @@ def gather_context(api, context, results):
     if not context or not results:
         return {}
 
-    # parse the context requirements
-    if context is True:
-        langs = True
-        featureSpec = True
-        doLocality = True
-        textFormats = True
-    else:
-        langs = context.get('languages', set())
-        featureSpec = context.get('features', set())
-        doLocality = context.get('locality', False)
-        textFormats = context.get('formats', set())
-
-    if type(langs) is str:
-        langs = set(langs.strip().split())
-    elif langs is True:
-        langs = set(T.languages)
-
-    if type(featureSpec) is str:
-        featureSpec = set(featureSpec.strip().split())
-    elif featureSpec is True:
-        featureSpec = {f[0] for f in TF.features.items() if not (f[1].isConfig or f[1].method)}
-    else:
-        featureSpec = {fName for fName in featureSpec}
-
-    testLangs = langs | {None}
-    featureSpec = {fName for fName in featureSpec if _depLang(fName) in testLangs}
-
-    if type(textFormats) is str:
-        textFormats = set(textFormats.strip().split())
-    elif textFormats is True:
-        textFormats = T.formats
+    langs, featureSpec, doLocality, textFormats = _parseContext(api, context)
 
     # generate context: features
 
@@ -236,6 +211,206 @@ def gather_context(api, context, results):
     )
 
 
+# A vectorized gather_context for repeated calls on the same api: node
+# membership is a boolean mask over the node range, node features are indexed
+# in bulk from object arrays (built once per feature), and edge and locality
+# lists are filtered on the mask all at once. The result is identical to that
+# of gather_context.
+class ContextGatherer(object):
+    def __init__(self, api):
+        self.api = api
+        self.maxNode = api.F.otype.maxNode
+        self.maxSlot = api.F.otype.maxSlot
+        self.featureArrays = {}
+        self.localityCache = {member: {} for member in ('u', 'd', 'n', 'p')}
+
+    def featureArray(self, f):
+        arr = self.featureArrays.get(f, None)
+        if arr is None:
+            arr = np.full(self.maxNode + 1, None, dtype=object)
+            items = list(self.api.Fs(f).items())
+            nodes = np.fromiter((n for (n, v) in items), dtype=np.int64, count=len(items))
+            values = np.empty(len(items), dtype=object)
+            values[:] = [v for (n, v) in items]
+            arr[nodes] = values
+            self.featureArrays[f] = arr
+        return arr
+
+    # Long locality lists (e.g. L.d of a frequent lexeme) are needed for many
+    # chapters and expensive to compute, so they are kept across calls as
+    # arrays. Short lists are returned as tuples.
+    def localityLists(self, member, nodes):
+        memberFunction = getattr(self.api.L, member)
+        cache = self.localityCache[member]
+        lists = []
+        for n in nodes:
+            ms = cache.get(n, None)
+            if ms is None:
+                ms = memberFunction(n)
+                if len(ms) >= LOCALITY_CACHE_MIN:
+                    ms = np.array(ms, dtype=np.int64)
+                    cache[n] = ms
+            lists.append(ms)
+        return lists
+
+    # Like filterLists, but long lists are arrays from localityLists, which
+    # are filtered on their own so that only the kept nodes are converted.
+    def filterLocality(self, lists, mask):
+        short = [i for (i, ms) in enumerate(lists) if type(ms) is not np.ndarray]
+        result = [None] * len(lists)
+        for (i, ms) in zip(short, self.filterLists([lists[i] for i in short], mask)):
+            result[i] = ms
+        for (i, ms) in enumerate(lists):
+            if result[i] is None:
+                result[i] = tuple(ms[mask[ms]].tolist())
+        return result
+
+    def mask(self, nodes):
+        mask = np.zeros(self.maxNode + 1, dtype=bool)
+        mask[nodes] = True
+        return mask
+
+    def filterLists(self, lists, mask, hasValues=False):
+        lengths = np.fromiter((len(ms) for ms in lists), dtype=np.int64, count=len(lists))
+        total = int(lengths.sum())
+        if hasValues:
+            items = list(chain.from_iterable(lists))
+            keys = np.fromiter((x[0] for x in items), dtype=np.int64, count=total)
+        else:
+            keys = np.fromiter(chain.from_iterable(lists), dtype=np.int64, count=total)
+        keep = mask[keys]
+        owners = np.repeat(np.arange(len(lists)), lengths)
+        ends = np.cumsum(np.bincount(owners[keep], minlength=len(lists))).tolist()
+        if hasValues:
+            kept = list(compress(items, keep.tolist()))
+        else:
+            kept = keys[keep].tolist()
+        result = []
+        start = 0
+        for end in ends:
+            result.append(tuple(kept[start:end]))
+            start = end
+        return result
+
+    def gather(self, context, results):
+        api = self.api
+        Es = api.Es
+        T = api.T
+        TF = api.TF
+        sortNodes = api.sortNodes
+
+        # quit quickly if no context is required
+        if not context or not results:
+            return {}
+
+        langs, featureSpec, doLocality, textFormats = _parseContext(api, context)
+
+        # generate context: features
+
+        loadedFeatures = api.ensureLoaded(featureSpec)
+        allNodes = reduce(
+                set.union,
+                (set(r) for r in results),
+                set(),
+        )
+        nodeArray = np.array(sorted(allNodes), dtype=np.int64)
+        nodeList = nodeArray.tolist()
+        mask = self.mask(nodeArray)
+
+        def dictOf(lists):
+            return {n: ms for (n, ms) in zip(nodeList, lists) if ms}
+
+        features = {}
+        featureType = {}
+        for f in sorted(loadedFeatures):
+            fObj = TF.features[f]
+            isEdge = fObj.isEdge
+            isNode = not (isEdge or fObj.isConfig or fObj.method)
+            if isNode:
+                featureType[f] = 0
+                values = self.featureArray(f)[nodeArray]
+                present = np.not_equal(values, None)
+                features[f] = dict(zip(nodeArray[present].tolist(), values[present].tolist()))
+            elif isEdge:
+                if f == 'oslots':
+                    featureType[f] = -1
+                    features[f] = dictOf(self.filterLists(
+                            [Es(f).s(n) for n in nodeList], mask))
+                else:
+                    hasValues = TF.features[f].edgeValues
+                    featureType[f] = 1 if hasValues else -1
+                    dataF = dictOf(self.filterLists(
+                            [Es(f).f(n) for n in nodeList], mask, hasValues))
+                    dataT = dictOf(self.filterLists(
+                            [Es(f).t(n) for n in nodeList], mask, hasValues))
+                    features[f] = (dataF, dataT)
+
+        # generate context: locality
+
+        locality = {}
+        if doLocality:
+            for member in ('u', 'd', 'n', 'p'):
+                lists = self.filterLocality(self.localityLists(member, nodeList), mask)
+                locality[member] = dict(zip(nodeList, lists))
+
+        # generate context: formats
+
+        text = {}
+        slots = nodeArray[nodeArray <= self.maxSlot].tolist()
+        for fmt in textFormats:
+            data = {}
+            for n in slots:
+                data[n] = T.text([n], fmt=fmt)
+            text[fmt] = data
+
+        return dict(
+                nodes=','.join(str(n) for n in sortNodes(allNodes)),
+                features=features,
+                featureType=featureType,
+                locality=locality,
+                text=text,
+                langs=langs,
+        )
+
+
+def _parseContext(api, context):
+    T = api.T
+    TF = api.TF
+
+    if context is True:
+        langs = True
+        featureSpec = True
+        doLocality = True
+        textFormats = True
+    else:
+        langs = context.get('languages', set())
+        featureSpec = context.get('features', set())
+        doLocality = context.get('locality', False)
+        textFormats = context.get('formats', set())
+
+    if type(langs) is str:
+        langs = set(langs.strip().split())
+    elif langs is True:
+        langs = set(T.languages)
+
+    if type(featureSpec) is str:
+        featureSpec = set(featureSpec.strip().split())
+    elif featureSpec is True:
+        featureSpec = {f[0] for f in TF.features.items() if not (f[1].isConfig or f[1].method)}
+    else:
+        featureSpec = {fName for fName in featureSpec}
+
+    testLangs = langs | {None}
+    featureSpec = {fName for fName in featureSpec if _depLang(fName) in testLangs}
+
+    if type(textFormats) is str:
+        textFormats = set(textFormats.strip().split())
+    elif textFormats is True:
+        textFormats = T.formats
+
+    return (langs, featureSpec, doLocality, textFormats)
+
+
 def _depLang(feature):
     if '@' not in feature:
         return None